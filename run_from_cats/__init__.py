@@ -22,26 +22,52 @@ Date: 2024-11-12
 """
 
 
+import atexit
 import json
-import time
 import logging
+import os
 import pickle
 import random
+import signal
+import struct
+import sys
+import time
 
-from typing import Union, List
+from typing import Callable, List
 
 import requests
 
+from requests.adapters import HTTPAdapter
+
 # Size of the game grid (must be an odd number). Default: 5.
 FIELD_SIZE = 5
 # The middle index of the grid. Also, player's coordinates are MIDDLE_POS, MIDDLE_POS
 MIDDLE_POS: int = (FIELD_SIZE - 1) // 2
+# Number of cells on the grid.
+FIELD_CELLS = FIELD_SIZE * FIELD_SIZE
+# Buffer index of the player's cell.
+PLAYER_CELL = MIDDLE_POS * FIELD_SIZE + MIDDLE_POS
 
 PLAYER_SYMBOL = '🙂'    # Represents the player.
 CAT_SYMBOL = '🐱'       # Represents cats.
 OBSTACLE_SYMBOL = '🌳'  # Represents obstacles.
 EMPTY_SYMBOL = '🟩'     # Represents an empty cell.
 
+# Byte codes stored in the field buffer for each kind of cell.
+B_EMPTY = 0
+B_CAT = 1
+B_OBSTACLE = 2
+B_PLAYER = 3
+# Symbols indexed by cell byte code.
+SYMBOLS = (EMPTY_SYMBOL, CAT_SYMBOL, OBSTACLE_SYMBOL, PLAYER_SYMBOL)
+# Cell byte codes by symbol.
+SYMBOL_CODES = {symbol: code for code, symbol in enumerate(SYMBOLS)}
+# Cells of an empty field with the player in the center.
+CLEAR_FIELD = bytes(PLAYER_CELL) + bytes((B_PLAYER,)) + bytes(PLAYER_CELL)
+
+# Cells of an empty row or column.
+EMPTY_LINE = bytes(FIELD_SIZE)
+
 # Predefined messages for game events.
 GREETING_MESSAGE = 'Hi, {}! To start game, press /newgame'
 NEW_GAME_MESSAGE = "You have to run from cats! I don't know why. Just run.\n"
@@ -55,52 +81,240 @@ NAVIGATED_MESSAGE = '⠀' * (FIELD_SIZE + 2) + '/up\n' + \
                     ('⠀⠀⠀' + "{}" * FIELD_SIZE + '\n') * MIDDLE_POS +\
                     '⠀' * (FIELD_SIZE + 2) + '/down'
 
-# Dictionary mapping movement directions to their opposites.
-# If player runs to the left, we have move objects to the right.
-DIRECTIONS = {
-    'left': 'right',
-    'right': 'left',
-    'up': 'down',
-    'down': 'up'
+# Seconds Telegram holds a getUpdates request open waiting for new updates.
+LONG_POLLING_TIMEOUT = 25
+# Seconds to wait for Telegram's response before giving up.
+REQUEST_TIMEOUT = LONG_POLLING_TIMEOUT + 5
+# Kinds of updates the bot handles, other updates aren't sent by Telegram.
+ALLOWED_UPDATES = json.dumps(['message'])
+
+# Game fields and bot state are written to disk once per this many updates
+# or once per this many seconds, whichever comes first, and on shutdown.
+SAVE_EVERY_UPDATES = 10
+SAVE_INTERVAL = 60
+# Player's field file starts with the format version and the field size.
+FIELD_FILE_VERSION = 1
+FIELD_FILE_HEADER = struct.Struct('<BB')
+
+# Codes of movement directions.
+LEFT = 0
+RIGHT = 1
+UP = 2
+DOWN = 3
+# Direction codes by the names used in bot commands.
+DIRECTION_CODES = {
+    'left': LEFT,
+    'right': RIGHT,
+    'up': UP,
+    'down': DOWN,
 }
 
-# Predefined positions around the player to check for cats.
-POSITIONS_TO_CHECK_CATS = [
-    (MIDDLE_POS, MIDDLE_POS - 1),
-    (MIDDLE_POS, MIDDLE_POS + 1),
-    (MIDDLE_POS - 1, MIDDLE_POS),
-    (MIDDLE_POS + 1, MIDDLE_POS),
-]
+# Opposites of movement directions, indexed by direction code.
+# If player runs to the left, we have move objects to the right.
+DIRECTIONS = (RIGHT, LEFT, DOWN, UP)
+
+# Buffer indices of the cells around the player to check for cats.
+LEFT_OF_PLAYER = PLAYER_CELL - 1
+RIGHT_OF_PLAYER = PLAYER_CELL + 1
+ABOVE_PLAYER = PLAYER_CELL - FIELD_SIZE
+BELOW_PLAYER = PLAYER_CELL + FIELD_SIZE
+
+# Shift of coordinates for each movement direction, indexed by direction code.
+DIRECTION_OFFSETS = ((0, -1), (0, 1), (-1, 0), (1, 0))
 
 
-class Position:
+def make_renderer(template: str) -> Callable[[bytes], str]:
     """
-    Represents a single cell on the game field.
+    Prepares a function filling the message template with
+    the symbols of the field cells.
 
-    Attributes:
-        :param x (int): row coordinate
-        :param y (int): column coordinate
-        :param data(str): the symbol representing the cell content.
+    :param template: message with a '{}' slot for every cell
+    :return: function taking the field cells and returning the message
     """
-    def __init__(self, x: int, y: int, data: str) -> None:
-        self.x = x
-        self.y = y
-        self.data = data
+    # Literal parts go to even places, cell symbols fill odd ones.
+    parts = []
+    for part in template.split('{}'):
+        parts.extend((part, None))
+    parts.pop()
+    symbol = SYMBOLS.__getitem__
 
-    def manhattan(self, other_position: Union['Position', tuple[int, int]]) -> int:
-        """
-        Calculates the Manhattan distance between the
-        current position and another position.
+    def render(buf: bytes) -> str:
+        out = parts.copy()
+        out[1::2] = map(symbol, buf)
+        return ''.join(out)
 
-        :param other_position: another position
-        :return: int: the manhattan distance
-        """
-        if isinstance(other_position, Position):
-            return abs(self.x - other_position.x) + abs(self.y - other_position.y)
-        return abs(self.x - other_position[0]) + abs(self.y - other_position[1])
+    return render
 
-    def __str__(self) -> str:
-        return self.data
+
+render_field_message = make_renderer(FIELD_MESSAGE)
+render_navigated_message = make_renderer(NAVIGATED_MESSAGE)
+
+
+def manhattan(x: int, y: int) -> int:
+    """
+    Calculates the Manhattan distance between a cell and the player,
+    who always stays at (MIDDLE_POS, MIDDLE_POS).
+
+    :param x: row coordinate
+    :param y: column coordinate
+    :return: int: the manhattan distance
+    """
+    return abs(x - MIDDLE_POS) + abs(y - MIDDLE_POS)
+
+
+# Distance to the player for every buffer index.
+CELL_DISTANCES = tuple(manhattan(*divmod(i, FIELD_SIZE)) for i in range(FIELD_CELLS))
+
+# (direction code, buffer index) of the neighbours inside the field
+# for every buffer index, in LEFT, RIGHT, UP, DOWN order.
+NEIGHBOURS = tuple(
+    tuple(
+        (direction, (row + dx) * FIELD_SIZE + col + dy)
+        for direction, (dx, dy) in enumerate(DIRECTION_OFFSETS)
+        if 0 <= row + dx < FIELD_SIZE and 0 <= col + dy < FIELD_SIZE
+    )
+    for row, col in (divmod(i, FIELD_SIZE) for i in range(FIELD_CELLS))
+)
+
+# Buffer indices of the edge cells where new cats may appear.
+CAT_SPAWN_CELLS = tuple(
+    i for i in range(FIELD_CELLS)
+    if len(NEIGHBOURS[i]) < 4 and CELL_DISTANCES[i] >= 2
+)
+
+
+def best_cat_move(cat_row: int, cat_column: int, blocked_mask: int) -> tuple[int, int]:
+    """
+    Chooses the step that brings a cat closest to the player.
+    Cells outside the field are always treated as blocked.
+
+    :param cat_row: row of the cat
+    :param cat_column: column of the cat
+    :param blocked_mask: bit number <direction code> is set if the
+        neighbour cell in that direction is occupied
+    :return: (row, column) offset of the step, (0, 0) to stay in place
+    """
+    i = cat_row * FIELD_SIZE + cat_column
+    current_move = (0, 0)
+    current_distance = CELL_DISTANCES[i]
+
+    for direction, neighbour in NEIGHBOURS[i]:
+        if blocked_mask & (1 << direction):
+            continue
+        if CELL_DISTANCES[neighbour] < current_distance:
+            current_distance = CELL_DISTANCES[neighbour]
+            current_move = DIRECTION_OFFSETS[direction]
+
+    return current_move
+
+
+# Cat steps for every cat position and neighbours blocked mask:
+# BEST_MOVE[row][column][mask] == best_cat_move(row, column, mask)
+BEST_MOVE = tuple(
+    tuple(
+        tuple(best_cat_move(row, col, mask) for mask in range(16))
+        for col in range(FIELD_SIZE)
+    )
+    for row in range(FIELD_SIZE)
+)
+
+
+def is_valid_field(cells: bytes) -> bool:
+    """
+    Checks if loaded cells make a field: known cell codes
+    and the only player standing in the center.
+
+    :param cells: FIELD_SIZE * FIELD_SIZE cell byte codes, row by row
+    :return: True if the field is valid, False otherwise
+    """
+    return len(cells) == FIELD_CELLS and max(cells) <= B_PLAYER and\
+        cells[PLAYER_CELL] == B_PLAYER and cells.count(B_PLAYER) == 1
+
+
+def is_player_caught(buf: bytearray) -> bool:
+    """
+    Checks if a cat stands next to the player.
+
+    :param buf: cells of the field
+    :return: True if the player is caught, False otherwise
+    """
+    return buf[LEFT_OF_PLAYER] == B_CAT or buf[RIGHT_OF_PLAYER] == B_CAT or\
+        buf[ABOVE_PLAYER] == B_CAT or buf[BELOW_PLAYER] == B_CAT
+
+
+def step_cat(buf: bytearray, cat_row: int, cat_column: int) -> tuple[int, int]:
+    """
+    Moves a cat one step closer to the player in the field buffer.
+
+    :param buf: cells of the field
+    :param cat_row: row of the cat
+    :param cat_column: column of the cat
+    :return: new (row, column) of the cat
+    """
+    i = cat_row * FIELD_SIZE + cat_column
+    # Neighbours outside the field wrap around to other cells,
+    # their bits don't matter since BEST_MOVE never steps there.
+    mask = (buf[i - 1] != B_EMPTY) |\
+           (buf[(i + 1) % FIELD_CELLS] != B_EMPTY) << 1 |\
+           (buf[i - FIELD_SIZE] != B_EMPTY) << 2 |\
+           (buf[(i + FIELD_SIZE) % FIELD_CELLS] != B_EMPTY) << 3
+    dx, dy = BEST_MOVE[cat_row][cat_column][mask]
+
+    buf[i] = B_EMPTY
+    buf[i + dx * FIELD_SIZE + dy] = B_CAT
+    return cat_row + dx, cat_column + dy
+
+
+def step_cats(buf: bytearray, cats: List[tuple[int, int]]) -> None:
+    """
+    Moves cats one by one until one of them reaches the player.
+
+    :param buf: cells of the field
+    :param cats: coordinates of the cats, updated in place
+    :return: None
+    """
+    for k, (cat_row, cat_column) in enumerate(cats):
+        cats[k] = step_cat(buf, cat_row, cat_column)
+        if is_player_caught(buf):
+            return
+
+
+def shift_left(buf: bytearray) -> None:
+    """Shifts the field cells one column to the left, adding obstacles on the right."""
+    # Each row's first cell lands in the previous row's
+    # last column, which is cleared right after.
+    buf[:-1] = buf[1:]
+    buf[FIELD_SIZE - 1::FIELD_SIZE] = EMPTY_LINE
+
+    for i in range(2):
+        random_row = random.randint(0, FIELD_SIZE - 1)
+        buf[random_row * FIELD_SIZE + FIELD_SIZE - 1] = B_OBSTACLE
+
+
+def shift_right(buf: bytearray) -> None:
+    """Shifts the field cells one column to the right, adding obstacles on the left."""
+    buf[1:] = buf[:-1]
+    buf[::FIELD_SIZE] = EMPTY_LINE
+
+    for i in range(2):
+        random_row = random.randint(0, FIELD_SIZE - 1)
+        buf[random_row * FIELD_SIZE] = B_OBSTACLE
+
+
+def shift_up(buf: bytearray) -> None:
+    """Shifts the field cells one row up, generating a new bottom row."""
+    buf[:FIELD_CELLS - FIELD_SIZE] = buf[FIELD_SIZE:]
+    buf[FIELD_CELLS - FIELD_SIZE:] = GameField.generate_row()
+
+
+def shift_down(buf: bytearray) -> None:
+    """Shifts the field cells one row down, generating a new top row."""
+    buf[FIELD_SIZE:] = buf[:FIELD_CELLS - FIELD_SIZE]
+    buf[:FIELD_SIZE] = GameField.generate_row()
+
+
+# Shift functions indexed by direction code.
+SHIFTS = (shift_left, shift_right, shift_up, shift_down)
 
 
 class GameField:
@@ -108,79 +322,88 @@ class GameField:
     Represents the game field where the game takes place.
 
     Attributes:
-        :param field_data (List[List[Position]]): the game field data.
+        :param buf (bytearray): the game field data, one byte per cell,
+            stored row by row (cell (row, col) is buf[row * FIELD_SIZE + col]).
+        :param cats (List[tuple[int, int]]): coordinates of all cats on the field.
     """
     def __init__(self) -> None:
-        self.field_data = self.generate_clear()
+        self.buf = self.generate_clear()
+        self.cats = []
+        self.generate_cats()
+        self.generate_obstacles()
+
+    def reset(self) -> None:
+        """
+        Starts a new game on this field without reallocating it.
+
+        :return: None
+        """
+        self.buf[:] = CLEAR_FIELD
+        self.cats.clear()
         self.generate_cats()
         self.generate_obstacles()
 
     def __str__(self) -> str:
-        return '\n'.join(''.join(str(col) for col in row)\
-                         for row in self.field_data)
+        return '\n'.join(''.join(SYMBOLS[cell] for cell in
+                                 self.buf[row * FIELD_SIZE:(row + 1) * FIELD_SIZE])
+                         for row in range(FIELD_SIZE))
+
+    def __getitem__(self, item: tuple[int, int]) -> int:
+        """
+        Allows direct access to cells using [row, col]
+        x.__getitem__((row, col)) <==> x.buf[row * FIELD_SIZE + col]
+        """
+        row, col = item
+        return self.buf[row * FIELD_SIZE + col]
 
-    def __getitem__(self, item) -> Union[Position, List[Position]]:
+    @classmethod
+    def from_buffer(cls, buf: bytes) -> 'GameField':
         """
-        Allows direct access to rows or positions using []
-        x.__getitem__(y) <==> x.field_data[y]
+        Restores a game field from its cells.
+
+        :param buf: FIELD_SIZE * FIELD_SIZE cell byte codes, row by row
+        :return: restored field
         """
-        return self.field_data[item]
+        field = cls.__new__(cls)
+        field.buf = bytearray(buf)
+        field.cats = [divmod(i, FIELD_SIZE) for i, cell in enumerate(field.buf)
+                      if cell == B_CAT]
+        return field
 
     @staticmethod
-    def generate_row(row_index: int) -> List[Position]:
+    def generate_row() -> bytearray:
         """
         Generates a single row with random obstacles.
 
-        :param row_index: index of the new row
         :return: generated row
         """
-        result = []
-        for col in range(FIELD_SIZE):
-            result.append(Position(row_index, col, EMPTY_SYMBOL))
-
+        result = bytearray(FIELD_SIZE)
         for i in range(FIELD_SIZE // 3):
-            random.choice(result).data = OBSTACLE_SYMBOL
-
+            result[random.randint(0, FIELD_SIZE - 1)] = B_OBSTACLE
         return result
 
     @staticmethod
-    def generate_clear() -> List[List[Position]]:
+    def generate_clear() -> bytearray:
         """
          Creates an empty field and places the player in the center.
 
         :return: generated field
         """
-        result = [[] for _ in range(FIELD_SIZE)]
-        for row in range(FIELD_SIZE):
-            for col in range(FIELD_SIZE):
-                result[row].append(Position(row, col, EMPTY_SYMBOL))
-        result[MIDDLE_POS][MIDDLE_POS].data = PLAYER_SYMBOL
-        return result
+        return bytearray(CLEAR_FIELD)
 
     def generate_cats(self, number: int = 1) -> None:
         """
         Spawns a given number of cats at random edges of the field.
+        Spawns fewer cats if there are not enough free edge cells.
 
         :param number: number of cats to spawn
         :return: None
         """
-        cats_generated = 0
-        while cats_generated < number:
-            random_coordinate = random.randint(0, FIELD_SIZE - 1)
-            possible_cats_positions = [
-                (0, random_coordinate),
-                (FIELD_SIZE - 1, random_coordinate),
-                (random_coordinate, 0),
-                (random_coordinate, FIELD_SIZE - 1),
-            ]
-            new_cat_position = random.choice(possible_cats_positions)
-            x, y = new_cat_position
-            if self[x][y].data != EMPTY_SYMBOL:
-                continue
-            if self[MIDDLE_POS][MIDDLE_POS].manhattan((x, y)) < 2:
-                continue
-            self[x][y].data = CAT_SYMBOL
-            cats_generated += 1
+        buf = self.buf
+        candidates = [i for i in CAT_SPAWN_CELLS if buf[i] == B_EMPTY]
+        for i in random.sample(candidates, min(number, len(candidates))):
+            buf[i] = B_CAT
+            self.cats.append(divmod(i, FIELD_SIZE))
 
     def generate_obstacles(self, obstacles_number: int = 3) -> None:
         """
@@ -189,95 +412,29 @@ class GameField:
         :param obstacles_number: number of obstacles to place
         :return: None
         """
-        obstacles_generated = 0
-        while obstacles_generated < obstacles_number:
-            x, y = (random.randint(0, FIELD_SIZE - 1),
-                    random.randint(0, FIELD_SIZE - 1))
-            if self[x][y].data != EMPTY_SYMBOL:
-                continue
-            self[x][y].data = OBSTACLE_SYMBOL
-            obstacles_generated += 1
+        buf = self.buf
+        candidates = [i for i in range(FIELD_CELLS) if buf[i] == B_EMPTY]
+        for i in random.sample(candidates, min(obstacles_number, len(candidates))):
+            buf[i] = B_OBSTACLE
 
-    def move_objects(self, direction: str) -> None:
+    def move_objects(self, direction: int) -> None:
         """
         Moves all objects on the field based on the player's movement direction.
 
-        :param direction: either 'left' or 'right' or 'up' or 'down'
+        :param direction: either LEFT or RIGHT or UP or DOWN
         :return: None
         """
+        buf = self.buf
         # Remove player from field
-        self[MIDDLE_POS][MIDDLE_POS].data = EMPTY_SYMBOL
-        match direction:
-            case 'left':
-                for row in range(FIELD_SIZE):
-                    new_row = self[row][1:]
-                    new_row.append(Position(row, FIELD_SIZE, EMPTY_SYMBOL))
-                    self.field_data[row] = new_row
-                    for col in range(FIELD_SIZE):
-                        self[row][col].y -= 1
-
-                for i in range(2):
-                    random_row = random.randint(0, FIELD_SIZE - 1)
-                    self[random_row][FIELD_SIZE - 1].data = OBSTACLE_SYMBOL
-            case 'right':
-                for row in range(FIELD_SIZE):
-                    new_row = [Position(row, -1, EMPTY_SYMBOL)]
-                    new_row.extend(self[row][:-1])
-                    self.field_data[row] = new_row
-                    for col in range(FIELD_SIZE):
-                        self[row][col].y += 1
-
-                for i in range(2):
-                    random_row = random.randint(0, FIELD_SIZE - 1)
-                    self[random_row][0].data = OBSTACLE_SYMBOL
-            case 'up':
-                for row in range(FIELD_SIZE - 1):
-                    self.field_data[row] = self.field_data[row + 1]
-                    for col in range(FIELD_SIZE - 1):
-                        self[row][col].x -= 1
-                self.field_data[FIELD_SIZE - 1] = self.generate_row(FIELD_SIZE - 1)
-            case 'down':
-                for row in range(FIELD_SIZE - 1, 0, -1):
-                    print(row)
-                    self.field_data[row] = self.field_data[row - 1]
-                    for col in range(FIELD_SIZE - 1):
-                        self[row][col].x += 1
-                self.field_data[0] = self.generate_row(0)
+        buf[PLAYER_CELL] = B_EMPTY
+        SHIFTS[direction](buf)
         # Return player to field
-        self[MIDDLE_POS][MIDDLE_POS].data = PLAYER_SYMBOL
-
-    def move_cat(self, cat_row: int, cat_column: int):
-        """
-        Moves a cat one step closer to the player.
+        buf[PLAYER_CELL] = B_PLAYER
 
-        :param cat_row: row of the cat
-        :param cat_column: column of the cat
-        :return: None
-        """
-        positions_to_check = [
-            (cat_row, cat_column),
-            (cat_row, cat_column - 1),
-            (cat_row, cat_column + 1),
-            (cat_row - 1, cat_column),
-            (cat_row + 1, cat_column),
-        ]
-        current_position = positions_to_check[0]
-        current_distance = self[MIDDLE_POS][MIDDLE_POS].manhattan(current_position)
-
-        for position in positions_to_check[1:]:
-            x, y = position
-            if x < 0 or x >= FIELD_SIZE or y < 0 or y >= FIELD_SIZE:
-                continue
-            if self[x][y].data != EMPTY_SYMBOL:
-                continue
-            new_distance = self[MIDDLE_POS][MIDDLE_POS].manhattan(position)
-            if new_distance < current_distance:
-                current_distance = new_distance
-                current_position = position
-
-        self.field_data[cat_row][cat_column].data = EMPTY_SYMBOL
-        x, y = current_position
-        self.field_data[x][y].data = CAT_SYMBOL
+        # Cats shifted beyond the edge are gone
+        dx, dy = DIRECTION_OFFSETS[direction]
+        self.cats[:] = [(x + dx, y + dy) for x, y in self.cats
+                        if 0 <= x + dx < FIELD_SIZE and 0 <= y + dy < FIELD_SIZE]
 
     def proceed_cats_turn(self) -> None:
         """
@@ -285,12 +442,7 @@ class GameField:
 
         :return: None
         """
-        for row in range(FIELD_SIZE):
-            for col in range(FIELD_SIZE):
-                if self[row][col].data == CAT_SYMBOL:
-                    self.move_cat(row, col)
-                    if self.is_game_over():
-                        return
+        step_cats(self.buf, self.cats)
 
     def is_game_over(self) -> bool:
         """
@@ -298,30 +450,54 @@ class GameField:
 
         :return: True if the game is over, False otherwise
         """
-        return any(self[x][y].data == CAT_SYMBOL for x, y in POSITIONS_TO_CHECK_CATS)
+        return is_player_caught(self.buf)
 
-    def move_player(self, direction: str) -> None:
+    def move_player(self, direction: int) -> None:
         """
         Moves the player in the specified direction if the path is clear.
 
-        :param direction: either 'left' or 'right' or 'up' or 'down'
+        :param direction: either LEFT or RIGHT or UP or DOWN
         :return: None
         """
-        if direction not in DIRECTIONS:
+        if direction not in (LEFT, RIGHT, UP, DOWN):
             raise ValueError('invalid direction')
-        match direction:
-            case 'left':
-                if self[MIDDLE_POS][MIDDLE_POS - 1].data == EMPTY_SYMBOL:
-                    self.move_objects(DIRECTIONS[direction])
-            case 'right':
-                if self[MIDDLE_POS][MIDDLE_POS + 1].data == EMPTY_SYMBOL:
-                    self.move_objects(DIRECTIONS[direction])
-            case 'up':
-                if self[MIDDLE_POS - 1][MIDDLE_POS].data == EMPTY_SYMBOL:
-                    self.move_objects(DIRECTIONS[direction])
-            case 'down':
-                if self[MIDDLE_POS + 1][MIDDLE_POS].data == EMPTY_SYMBOL:
-                    self.move_objects(DIRECTIONS[direction])
+        dx, dy = DIRECTION_OFFSETS[direction]
+        if self.buf[PLAYER_CELL + dx * FIELD_SIZE + dy] == B_EMPTY:
+            self.move_objects(DIRECTIONS[direction])
+
+
+class LegacyFieldUnpickler(pickle.Unpickler):
+    """
+    Reads game fields pickled by earlier versions (./data/<chat_id>.pkl).
+
+    Pickled GameField and Position objects are restored as plain
+    attribute holders, any other class is refused, so a tampered
+    file can't run code.
+    """
+    class LegacyObject:
+        """Holds attributes of a pickled GameField or Position."""
+
+    def find_class(self, module: str, name: str) -> type:
+        if module == __name__ and name in ('GameField', 'Position'):
+            return self.LegacyObject
+        raise pickle.UnpicklingError(f'unexpected class {module}.{name}')
+
+    @staticmethod
+    def field_cells(field: LegacyObject) -> bytes:
+        """
+        Converts a pickled field to cells of the field buffer.
+
+        :param field: unpickled GameField with field_data of Position rows
+        :return: FIELD_SIZE * FIELD_SIZE cell byte codes, row by row
+        """
+        try:
+            cells = bytes(SYMBOL_CODES[position.data]
+                          for row in field.field_data for position in row)
+        except (AttributeError, KeyError, TypeError) as e:
+            raise ValueError(f'invalid legacy field: {e!r}') from e
+        if not is_valid_field(cells):
+            raise ValueError('invalid legacy field cells')
+        return cells
 
 
 class Bot:
@@ -334,18 +510,42 @@ class Bot:
         :param base_url (str): Base URL for Telegram Bot API requests
         :param last_update_id (int): The id of the last update
         :param players_data (dict[GameField]): Stores game fields for each player
+        :param session (requests.Session): Keeps connections to Telegram alive
+        :param dirty_chats (set[int]): Players whose fields are not saved yet
+        :param updates_since_save (int): Updates handled since the last save
+        :param last_save_time (float): time.monotonic() of the last save
     """
     def __init__(self, token) -> None:
         self.logger = logging.getLogger(__name__)
         self.base_url = f'https://api.telegram.org/bot{token}/'
         self.last_update_id = None
         self.players_data = dict()
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=10,
+                                                   pool_maxsize=10))
+        self.dirty_chats = set()
+        self.updates_since_save = 0
+        self.last_save_time = time.monotonic()
+
+    @staticmethod
+    def write_file(path: str, data: bytes) -> None:
+        """
+        Atomically replaces the file contents, so a crash
+        in the middle of writing never leaves a broken file.
+
+        :param path: path to the file
+        :param data: new contents
+        :return: None
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
 
     def save_state(self) -> None:
         """Saves the bot's state (e.g., last update ID) to a file."""
-        with open('./data/bot_state.json', 'w') as f:
-            state = {'last_update_id': self.last_update_id}
-            json.dump(state, f)
+        state = {'last_update_id': self.last_update_id}
+        self.write_file('./data/bot_state.json', json.dumps(state).encode())
 
     def load_state(self) -> None:
         """Loads the bot's state from a file."""
@@ -359,18 +559,71 @@ class Bot:
             self.logger.info("CAN'T LOAD BOT STATE. FILE NOT FOUND")
 
     def load_player_data(self, chat_id: int) -> None:
-        """Loads a player's game field from a file."""
-        with open(f'./data/{chat_id}.pkl', 'rb') as f:
-            self.players_data[chat_id] = pickle.load(f)
-        self.logger.debug(f'PLAYER {chat_id} LOADED FIELD:\n'
-                         f'{self.players_data[chat_id]}')
+        """
+        Loads a player's game field from a file.
+        The file holds the format version and field size bytes
+        followed by the field cells.
+        """
+        try:
+            with open(f'./data/{chat_id}.bin', 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.migrate_player_data(chat_id)
+            return
+        cells = data[FIELD_FILE_HEADER.size:]
+        if len(data) < FIELD_FILE_HEADER.size or\
+                FIELD_FILE_HEADER.unpack_from(data) != (FIELD_FILE_VERSION, FIELD_SIZE) or\
+                not is_valid_field(cells):
+            raise ValueError(f'invalid field file for player {chat_id}')
+        self.players_data[chat_id] = GameField.from_buffer(cells)
+        self.logger.debug('PLAYER %d LOADED FIELD:\n%s',
+                          chat_id, self.players_data[chat_id])
+
+    def migrate_player_data(self, chat_id: int) -> None:
+        """
+        Loads a player's game field pickled by an older version
+        and converts its file to the current format.
+        Raises FileNotFoundError if there's no such file and ValueError
+        if it can't be converted. A broken file is renamed to
+        <chat_id>.pkl.broken, so it isn't read again.
+        """
+        legacy_path = f'./data/{chat_id}.pkl'
+        with open(legacy_path, 'rb') as f:
+            try:
+                cells = LegacyFieldUnpickler.field_cells(LegacyFieldUnpickler(f).load())
+            except Exception as e:
+                error = e
+            else:
+                error = None
+        if error is not None:
+            os.replace(legacy_path, legacy_path + '.broken')
+            raise ValueError(f'invalid legacy field file for player {chat_id}') from error
+        self.players_data[chat_id] = GameField.from_buffer(cells)
+        self.save_player_data(chat_id)
+        os.remove(legacy_path)
+        self.logger.info('PLAYER %d FIELD MIGRATED FROM %s', chat_id, legacy_path)
 
     def save_player_data(self, chat_id: int) -> None:
         """Saves a player's game field to a file."""
-        with open(f'./data/{chat_id}.pkl', 'wb') as f:
-            pickle.dump(self.players_data[chat_id], f)
-        self.logger.debug(f'PLAYER {chat_id} SAVED FIELD:\n'
-                          f'{self.players_data[chat_id]}')
+        self.write_file(f'./data/{chat_id}.bin',
+                        FIELD_FILE_HEADER.pack(FIELD_FILE_VERSION, FIELD_SIZE) +
+                        self.players_data[chat_id].buf)
+        self.logger.debug('PLAYER %d SAVED FIELD:\n%s',
+                          chat_id, self.players_data[chat_id])
+
+    def flush(self) -> None:
+        """Saves fields of players who made moves and the bot's state."""
+        for chat_id in self.dirty_chats:
+            self.save_player_data(chat_id)
+        self.dirty_chats.clear()
+        self.save_state()
+        self.updates_since_save = 0
+        self.last_save_time = time.monotonic()
+
+    @staticmethod
+    def handle_sigterm(signum, frame) -> None:
+        """Stops the bot on SIGTERM, so that atexit handlers save its data."""
+        sys.exit(0)
 
     def get_updates(self, started) -> dict:
         """
@@ -380,57 +633,71 @@ class Bot:
         :return: Updates dictionary
         """
         url = f'{self.base_url}getUpdates'
+        params = {'timeout': LONG_POLLING_TIMEOUT,
+                  'allowed_updates': ALLOWED_UPDATES}
         if started:
-            url += '?offset=-1'
+            params['offset'] = -1
+        elif self.last_update_id is not None:
+            params['offset'] = self.last_update_id + 1
         try:
-            response = requests.get(url)
+            response = self.session.get(url, params=params,
+                                        timeout=REQUEST_TIMEOUT)
             response.raise_for_status()
             return response.json()
         except requests.RequestException as e:
-            self.logger.warning(f'ERROR FETCHING UPDATES: {e}')
+            self.logger.warning('ERROR FETCHING UPDATES: %s', e)
             return {'ok': False, 'result': []}
 
     def send_message(self, chat_id: int, text: str) -> None:
         """Sends a message to the specified chat."""
         url = f'{self.base_url}sendMessage'
-        requests.post(url, json={'chat_id': chat_id, 'text': text})
+        try:
+            response = self.session.post(url, json={'chat_id': chat_id, 'text': text},
+                                         timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            self.logger.warning('ERROR SENDING MESSAGE TO %d: %s', chat_id, e)
 
     def proceed_message(self, chat_id: int, user_name: str, message: str):
         """Processes incoming messages and performs the appropriate action."""
         match message:
             case '/newgame':
-                self.logger.info(f'PLAYER {chat_id} STARTS NEW GAME.')
-                self.players_data[chat_id] = GameField()
-                message = NEW_GAME_MESSAGE + NAVIGATED_MESSAGE.format(
-                    *(cell for row in self.players_data[chat_id] for cell in row)
+                self.logger.info('PLAYER %d STARTS NEW GAME.', chat_id)
+                if chat_id in self.players_data:
+                    self.players_data[chat_id].reset()
+                else:
+                    self.players_data[chat_id] = GameField()
+                message = NEW_GAME_MESSAGE + render_navigated_message(
+                    self.players_data[chat_id].buf
                 )
                 self.send_message(chat_id, message)
 
             case '/left' | '/right' | '/up' | '/down':
-                self.logger.debug(f'PROCEEDING PLAYER {chat_id} TURN {message}. '
-                                  f'STARTING FIELD STATE:\n{self.players_data[chat_id]}')
-                self.players_data[chat_id].move_player(message[1:])
-                self.logger.debug(f'OBJECTS MOVED:\n{self.players_data[chat_id]}')
+                self.logger.debug('PROCEEDING PLAYER %d TURN %s. '
+                                  'STARTING FIELD STATE:\n%s',
+                                  chat_id, message, self.players_data[chat_id])
+                self.players_data[chat_id].move_player(DIRECTION_CODES[message[1:]])
+                self.logger.debug('OBJECTS MOVED:\n%s', self.players_data[chat_id])
                 self.players_data[chat_id].proceed_cats_turn()
-                self.logger.debug(f'CATS MOVES PROCEEDED:\n{self.players_data[chat_id]}')
+                self.logger.debug('CATS MOVES PROCEEDED:\n%s', self.players_data[chat_id])
                 self.players_data[chat_id].generate_cats()
-                self.logger.debug(f'GENERATED NEW CATS:\n{self.players_data[chat_id]}')
+                self.logger.debug('GENERATED NEW CATS:\n%s', self.players_data[chat_id])
 
                 if self.players_data[chat_id].is_game_over():
-                    self.logger.info(f'PLAYER {chat_id} LOST GAME.')
-                    message = GAME_OVER_MESSAGE + FIELD_MESSAGE.format(
-                        *(cell for row in self.players_data[chat_id] for cell in row)
+                    self.logger.info('PLAYER %d LOST GAME.', chat_id)
+                    message = GAME_OVER_MESSAGE + render_field_message(
+                        self.players_data[chat_id].buf
                     )
                 else:
-                    message = GOOD_JOB_MESSAGE + NAVIGATED_MESSAGE.format(
-                        *(cell for row in self.players_data[chat_id] for cell in row)
+                    message = GOOD_JOB_MESSAGE + render_navigated_message(
+                        self.players_data[chat_id].buf
                     )
                 self.send_message(chat_id, message)
 
             case _:
                 if chat_id in self.players_data:
-                    message = PROGRESS_LOADED_MESSAGE + NAVIGATED_MESSAGE.format(
-                        *(cell for row in self.players_data[chat_id] for cell in row)
+                    message = PROGRESS_LOADED_MESSAGE + render_navigated_message(
+                        self.players_data[chat_id].buf
                     )
                 else:
                     message = GREETING_MESSAGE.format(user_name)
@@ -439,6 +706,8 @@ class Bot:
     def run(self):
         """Main loop for running the bot."""
         self.load_state()
+        atexit.register(self.flush)
+        signal.signal(signal.SIGTERM, self.handle_sigterm)
         just_started = True
 
         while True:
@@ -446,28 +715,37 @@ class Bot:
             just_started = False
             if updates.get('ok'):
                 for update in updates['result']:
+                    update_id = update['update_id']
+                    if self.last_update_id is not None and\
+                            update_id <= self.last_update_id:
+                        continue
+                    # Every update is acknowledged before it is handled, so
+                    # that neither non-message updates nor updates failing
+                    # to be processed come back from the next poll.
+                    self.last_update_id = update_id
+
                     if 'message' in update:
-                        update_id = update['update_id']
-                        if self.last_update_id is None or\
-                                update_id > self.last_update_id:
-                            chat_id = update['message']['chat']['id']
-
-                            if chat_id not in self.players_data:
-                                try:
-                                    self.load_player_data(chat_id)
-                                except FileNotFoundError:
-                                    self.players_data[chat_id] = GameField()
-                                    self.logger.debug(f"CAN'T LOAD PLAYER {chat_id}"
-                                                      'FIELD. CREATED NEW ONE.\n'
-                                                      f'{self.players_data[chat_id]}')
-
-                            message = update['message']['text']
-                            user_name = update['message']['from']['first_name']
-
-                            self.proceed_message(chat_id, user_name, message)
-                            self.save_player_data(chat_id)
-
-                            self.last_update_id = update_id
-                            self.save_state()
-
-                    time.sleep(3)
+                        chat_id = update['message']['chat']['id']
+
+                        if chat_id not in self.players_data:
+                            try:
+                                self.load_player_data(chat_id)
+                            except (FileNotFoundError, ValueError):
+                                self.players_data[chat_id] = GameField()
+                                self.logger.debug("CAN'T LOAD PLAYER %d "
+                                                  'FIELD. CREATED NEW ONE.\n%s',
+                                                  chat_id, self.players_data[chat_id])
+
+                        message = update['message'].get('text', '')
+                        user_name = update['message']['from']['first_name']
+
+                        self.proceed_message(chat_id, user_name, message)
+                        self.dirty_chats.add(chat_id)
+
+                    self.updates_since_save += 1
+                    if self.updates_since_save >= SAVE_EVERY_UPDATES:
+                        self.flush()
+
+            if self.updates_since_save and\
+                    time.monotonic() - self.last_save_time >= SAVE_INTERVAL:
+                self.flush()